@@ -23,6 +23,17 @@ from __future__ import print_function
 # Application, run...
 #  python rooster.py
 #
+#  To profile each phase (login, crawl, planning, metadata, parts, mux, publish) with cProfile and tracemalloc, run...
+#  python rooster.py --profile
+#  or for long runs, to only time each phase and sample the call stack every 10ms, run...
+#  python rooster.py --profile=sample
+#  Results are saved under <path/to/rooster>/_rooster_profile/
+#  Without tracemalloc (Python 2), or with --profile=sample, Peak MB is the process peak resident memory at phase end.
+#
+#  To only log in, crawl and plan which episodes are new, then output the plan as JSON with timings and exit, run...
+#  python rooster.py --plan
+#  The JSON plan is the only output to stdout, progress messages go to stderr.
+#
 # ==============================================================================================
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
@@ -32,14 +43,28 @@ from __future__ import print_function
 #
 #  Given one or more account details in settings.py and a set of urls,
 #  log in to roosterteeth, then fetch and parse episode m3u8 format meta files.
+#  Season and episode pages are parsed as they stream in, reading stops once the episode grid or player is found.
+#  A small rest of a page is read through so its keep-alive connection is reused, a large rest is closed.
+#  With ep_priority 'site', episodes are fetched as each season page is read, instead of after the whole crawl.
 #  For each episode meta file, download and parse available resolutions and associated file list urls.
 #  Starting with the highest resolution parsed, download its video url list file.
+#  Episodes are fetched in ep_priority order, an episode is only fetched if its estimated size (bandwidth x
+#  duration) fits temp_budget and free temp space, otherwise it is deferred until after the others, and left for a
+#  later run if it still does not fit (or with ep_fallback, a lower resolution that fits is fetched instead).
+#  Up to concurrent_fetches parts are fetched at once, fewer if needed to stay within memory_budget.
+#  Parts are saved in a temp workspace per episode.
 #  With the url list file, download each .ts video part therein.
 #  Output hashes after each part is successfully downloaded, output percentage progress at 5, 20, 40, 60, 80 and 95%
 #  For any error during transmission, fallback to the next highest known quality.
+#  Keep-alive connections are pooled per host and reused across episodes and accounts (each account has its own
+#  cookies), idle pools are closed after pool_idle seconds and connection reuse per host is output at the end.
 #  A template variable in the settings file allows the saved video filename a configurable output format.
 #  If output filepath exists in a flatfile db, the episode download is skipped.
 #  ffmpeg is used to join video parts into an mvk file by default or an mp4 file if mp4 is found in a url.
+#  ffmpeg writes into a local staging dir, the finished file is then published to show_parent by a rename, or by a
+#  checked background copy when staging and show_parent are on different filesystems (e.g. a network mount).
+#  The copy is read back for its SHA-1 once its cached pages are dropped, on win32 only its size is compared.
+#  An episode is only added to _filelist.txt once its file is published.
 #  ffmpeg (win32) exists in the /bin/ folder, any other platforms ffmpeg binary must be placed under the same location.
 #  Resolution and quality tag is used in the final video filename, for example...
 #  final file can be called <show_parent/rt-podcast/2017/rt-podcast.S2017E465.#465.1080p.WEBRip.mkv
@@ -49,17 +74,32 @@ from __future__ import print_function
 #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import cProfile
 import datetime
+import hashlib
+import json
 import os
 import pickle
+import pstats
 import random
 import re
 import signal
 import subprocess
 import sys
+import threading
 import time
 import warnings
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 import_ok = True
 try:
     # noinspection PyUnresolvedReferences
@@ -76,6 +116,54 @@ except ImportError:
     print('New settings need adding to your settings file. See temp_files in "settings - sample.py"')
     import_ok = False
 
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import stage_files
+except ImportError:
+    stage_files = '_rooster_stage'
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import temp_budget
+except ImportError:
+    temp_budget = 0
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import memory_budget
+except ImportError:
+    memory_budget = 256
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import ep_priority
+except ImportError:
+    ep_priority = 'site'
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import ep_fallback
+except ImportError:
+    ep_fallback = False
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import concurrent_fetches
+except ImportError:
+    concurrent_fetches = 5
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import pool_sizes
+except ImportError:
+    pool_sizes = {}
+
+try:
+    # noinspection PyUnresolvedReferences
+    from settings import pool_idle
+except ImportError:
+    pool_idle = 60
+
 try:
     # noinspection PyUnresolvedReferences
     import requests
@@ -93,9 +181,47 @@ except ImportError:
 if not import_ok:
     exit(1)
 
+from rooster_extract import iter_response, player_config, release, season_episodes
+
 warnings.filterwarnings('ignore', module=r'.*connectionpool.*')
 
 
+# running ffmpeg -version is slow, so the result is kept in ffmpegdb keyed by the binary path and modified time
+def probe_ffmpeg():
+    try:
+        key = '%s|%s' % (os.path.realpath(ffmpeg_bin), os.path.getmtime(ffmpeg_bin))
+    except OSError:
+        key = None
+    cache = load_obj(ffmpegdb) or {}
+    if None is not key and key in cache:
+        return cache[key]
+
+    try:
+        ffmpeg_buffer = subprocess.Popen([ffmpeg_bin, '-version'],
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
+        version = re.findall(r'(?sim)^(.*?version\s+[^\s]+)', ''.join([out for out in ffmpeg_buffer if out]))[0]
+    except OSError:
+        print('Error: Ffmpeg not installed, check that its executable is installed at: %s' % ffmpeg_bin)
+        exit(1)
+    except IndexError:
+        print('Error: Ffmpeg with version not found, check that its executable is installed at: %s' % ffmpeg_bin)
+        exit(1)
+
+    if None is not key:
+        save_obj({key: version}, ffmpegdb)
+    return version
+
+
+def make_temp_dirs():
+    for tmp_path in (temp_files, stage_files):
+        if not os.access(tmp_path, os.F_OK):
+            try:
+                os.makedirs(tmp_path, 0o744)
+            except os.error:
+                print(u'Unable to create required temp dir: %s' % tmp_path)
+                exit(1)
+
+
 def _print(msg):
     print(msg, end='')
 
@@ -152,6 +278,557 @@ def remove(saved_files):
             pass
 
 
+def make_path(path):
+    if not os.access(path, os.F_OK):
+        try:
+            os.makedirs(path, 0o744)
+        except os.error:
+            print(u'Unable to create dir: %s' % path)
+
+
+def same_device(path1, path2):
+    try:
+        return os.stat(path1).st_dev == os.stat(path2).st_dev
+    except OSError:
+        return False
+
+
+def replace_file(src, dst):
+    # rename does not overwrite on Windows
+    if 'win32' == sys.platform and os.path.isfile(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+# return sha1 of a file, if copy_name is given then a synced copy of the file is written while it is read
+def file_digest(filename, copy_name=None, digest=True):
+    sha1 = digest and hashlib.sha1()
+    wh = None
+    try:
+        with open(filename, 'rb') as rh:
+            wh = copy_name and open(copy_name, 'wb')
+            for chunk in iter(lambda: rh.read(1048576), b''):
+                if sha1:
+                    sha1.update(chunk)
+                if wh:
+                    wh.write(chunk)
+            if wh:
+                wh.flush()
+                os.fsync(wh.fileno())
+    finally:
+        if wh:
+            wh.close()
+    return sha1 and sha1.hexdigest()
+
+
+# drop the cached pages of a file so that it is read back from its server, os.posix_fadvise is Python 3.3+ so on
+# Python 2 libc is called, where libc has none (macOS) the file is read back as is
+def drop_cache(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        else:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+            libc.posix_fadvise(fd, 0, 0, 4)  # POSIX_FADV_DONTNEED
+    except (AttributeError, OSError):
+        pass
+    finally:
+        os.close(fd)
+
+
+# check a copy against what its server stored, not what is in the local page cache, by reading it back for its digest
+# once its cached pages are dropped, win32 has no way to drop them so only the sizes from a fresh stat are compared
+def copy_matches(stage_name, copy_name, digest):
+    if 'win32' == sys.platform:
+        return os.stat(stage_name).st_size == os.stat(copy_name).st_size
+    drop_cache(copy_name)
+    return digest == file_digest(copy_name)
+
+
+# add a published episode to its _filelist.txt
+def commit_log(log_meta, log_name):
+    global num_saved
+    with publish_lock:
+        log_file = log_meta['log_file']
+        make_path(os.path.split(log_file)[0])
+        log_meta['file_list'] += [log_name]
+        try:
+            with open('%s.tmp' % log_file, 'wb') as wh:
+                wh.write('\r\n'.join(log_meta['file_list']))
+            replace_file('%s.tmp' % log_file, log_file)
+        except (StandardError, Exception):
+            print('Error saving: %s' % log_file)
+        num_saved += 1
+
+
+# move a muxed file from staging to its final name, and only then record it in _filelist.txt
+# on one filesystem the file is renamed (atomic), otherwise it is queued for the worker to copy, check and rename
+# so that the next episode is fetched meanwhile
+def publish(stage_name, final_name, log_meta, log_name):
+    ep_path = os.path.split(final_name)[0]
+    make_path(ep_path)
+    if same_device(stage_name, ep_path):
+        try:
+            replace_file(stage_name, final_name)
+        except OSError as e:
+            print(u'Error publishing: %s, file kept at: %s (%s)' % (final_name, stage_name, e))
+            return
+        commit_log(log_meta, log_name)
+        return
+
+    global publisher
+    if not publisher:
+        publisher = threading.Thread(target=publish_worker, name='publisher')
+        publisher.daemon = True
+        publisher.start()
+    print(u'Queued for copy to: %s' % ep_path)
+    publish_q.put((stage_name, final_name, log_meta, log_name))
+
+
+def publish_worker():
+    while True:
+        stage_name, final_name, log_meta, log_name = publish_q.get()
+        part_name = '%s.partial' % final_name
+        try:
+            if not copy_matches(stage_name, part_name, file_digest(stage_name, part_name, 'win32' != sys.platform)):
+                raise IOError('copy does not match staged file')
+            replace_file(part_name, final_name)
+        except (StandardError, Exception) as e:
+            remove([part_name])
+            print(u'Error publishing: %s, file kept at: %s (%s)' % (final_name, stage_name, e))
+        else:
+            remove([stage_name])
+            commit_log(log_meta, log_name)
+            print(u'Published: %s' % final_name)
+        finally:
+            publish_q.task_done()
+
+
+def wait_published():
+    if publish_q.unfinished_tasks:
+        print('Waiting for %s file(s) to finish copying to archive...' % publish_q.unfinished_tasks)
+        publish_q.join()
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                size += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass
+    return size
+
+
+def free_space(path):
+    if 'win32' == sys.platform:
+        import ctypes
+        free = ctypes.c_ulonglong(0)
+        ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), None, None, ctypes.pointer(free))
+        return free.value
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+# bytes free for parts, capped by temp_budget (MB) less what is already used by temp and staging on the same disk
+def temp_room():
+    room = free_space(temp_files)
+    if temp_budget:
+        used = dir_size(temp_files) + (same_device(temp_files, stage_files) and dir_size(stage_files) or 0)
+        room = min(room, temp_budget * 1048576 - used)
+    return room
+
+
+# return how many parts to fetch at once to keep in-flight parts within memory_budget (MB),
+# or 0 if there is not temp room for the estimated parts (and the muxed file when staging is on the temp disk)
+def admit(est_bytes, num_parts, workspace):
+    shared_disk = same_device(temp_files, stage_files)
+    need = est_bytes * (1, 2)[shared_disk] - dir_size(workspace)
+    if need > temp_room() and shared_disk and publish_q.unfinished_tasks:
+        # staged files waiting on the archive copy free temp room once published
+        wait_published()
+    if need > temp_room():
+        return 0
+
+    part_bytes = est_bytes // max(1, num_parts)
+    if not part_bytes:
+        return concurrent_fetches
+    return max(1, min(concurrent_fetches, memory_budget * 1048576 // part_bytes))
+
+
+# fetch the episode page and m3u8 meta of an episode just before it is used, as the m3u8 urls expire, and estimate the
+# size of each resolution from its bandwidth and the duration in the best resolution playlist
+def fetch_meta(url):
+    ep_meta = meta[urlkey(url)]
+    print('Episode page: %s' % url)
+    try:
+        sleep_random()
+        # streamed so that reading stops once the player config is found
+        session.stream = True
+        resp = req.one(url)
+    except (StandardError, Exception):
+        return False
+    finally:
+        session.stream = False
+
+    # the streamed page is released on every path, so its connection goes back to the pool where it can
+    try:
+        if abort:
+            return False
+
+        if resp:
+            if resp.ok:
+                try:
+                    meta_url_m3u8, meta_title = player_config(iter_response(resp), bool(ep_append_title))
+                except (StandardError, Exception):
+                    meta_url_m3u8, meta_title = None, None
+                if not meta_url_m3u8:
+                    return False
+                if ep_append_title and None is not meta_title:
+                    # strip out any bad chars
+                    for c in bad_chars:
+                        meta_title = meta_title.replace(c, '')
+
+                    title_parts = re.split('-', meta_title)
+                    if 1 < len(title_parts):
+                        ep_meta['ep_name'] = ep_meta['ep_base'] + ep_append_title % dict(
+                            title=' - '.join([tp.strip() for tp in title_parts]),
+                            title_last_part=title_parts[-1].strip())
+            else:
+                print('Error response contains code:%s with short reason:%s' % (resp.status_code, resp.reason))
+                return False
+        else:
+            print('Error no data returned from server, check the site in a browser')
+            return False
+    finally:
+        if None is not resp:
+            release(resp)
+
+    print('Fetching episode meta...')
+    try:
+        sleep_random()
+        index_m3u8 = req.one(meta_url_m3u8)
+    except (StandardError, Exception):
+        return False
+    if abort:
+        return False
+
+    try:
+        options = re.findall('(?im)^(.*resolution=(\d+)x(\d+).*)[\r\n]+(.*)$', index_m3u8.content)
+    except (StandardError, Exception):
+        options = []
+    if not options:
+        print('m3u8 response has no resolution to pick best from, skipping episode: %s' % url)
+        return False
+
+    options = [(int(res_x), int(res_y), m3u8_url,
+                int((re.findall('(?i)(?:^|[:,])bandwidth=(\d+)', info) or [0])[0]))
+               for (info, res_x, res_y, m3u8_url) in options]
+    options.sort(key=lambda tu: tu[0], reverse=True)
+
+    base_url = meta_url_m3u8.rsplit('/', 1)[0]
+
+    # the best resolution playlist gives the episode duration, used to estimate the size of each resolution
+    playlists = {}
+    duration = 0
+    pick_url = options[0][2]
+    try:
+        sleep_random()
+        data_m3u8 = req.one(('%s/%s' % (base_url, pick_url), pick_url)[pick_url.startswith('http')])
+        if data_m3u8.ok:
+            playlists[pick_url] = data_m3u8.content
+            duration = sum([float(d) for d in re.findall('(?im)#EXTINF:\s*([\d.]+)', data_m3u8.content)])
+    except (StandardError, Exception):
+        pass
+    if abort:
+        return False
+
+    ep_meta.update(dict(base_url=base_url, options=options, playlists=playlists,
+                        est_bytes=[int(o[3] / 8 * duration) for o in options]))
+    return True
+
+
+# parse url into usable fragments (where x=season num and y=episode num) from...
+#  show_name-x-y
+#  show_name-season-x-y
+#  show_name-season-x-y
+#  show_name-volume-x-y
+#  show_name-volume-x-y
+#  show_name-season-x-episode-y
+#  show_name-season-x-chapter-y
+#  show_name-volume-x-episode-y
+#  show_name-volume-x-chapter-y
+# Otherwise treat as Special
+# returns True when the episode is new, and adds its meta
+def plan_episode(url):
+    show_name, season, episode, ep_path, log_path = 5 * [None]
+    try:
+        show_name_parts = re.findall('episode/([^"]+?)[-](.*)', url)[0]
+        show_name, remaining1 = show_name_parts[0], show_name_parts[1]
+        show_name = showname_maps.get(urlkey(url), show_name)
+
+        if re.search('(?i)^(?:[a-z]:[\\]|[/])', show_parent):
+            ep_path = os.path.join(os.path.realpath(show_parent), show_name)
+        else:
+            ep_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), show_parent, show_name)
+        log_path = os.path.join(ep_path, '_log')
+
+        season_parts = re.findall('(?:season-|volume-)?(\d+|20\d\d)(.*)', remaining1)[0]
+        season, remaining2 = season_parts[0], season_parts[1]
+        try:
+            # remove erroneous duplication before further parsing
+            remaining2 = re.findall('.*(?:season-|volume-)(\d+|20\d\d)(.*)', remaining2)[0][1]
+        except IndexError:
+            pass
+
+        episode = re.findall('^-(?:episode-|chapter-)?(\d+)', remaining2)[0]
+
+        season = '%02d' % int(season)
+        episode = '%02d' % int(episode)
+        season_dir = season_template % (dict(season_number=season))
+        log_path = os.path.join(log_path, season_dir)
+        ep_path = os.path.join(ep_path, season_dir)
+        ep_name = ep_template % (dict(show_name=show_name, season=season, episode=episode))
+
+    except IndexError:
+        if ep_path:
+            log_path = os.path.join(log_path, 'Specials')
+            ep_path = os.path.join(ep_path, 'Specials')
+            ep_name = url.rsplit('/', 1)[-1]
+
+    if show_name and ep_path:
+
+        # only add url to fetch meta where episode file does not already exist in _filelist.txt
+        log_file = os.path.join(log_path, '_filelist.txt')
+        log_key = urlkey(log_file)
+        if log_key not in log_lists:
+            file_list = []
+            if os.path.exists(log_file):
+                with open(log_file, 'r') as rh:
+                    file_list = rh.readlines()
+                file_list = [x.strip() for x in file_list]
+            log_lists[log_key] = dict(log_file=log_file, file_list=file_list[:], dedupe_list=file_list)
+
+        full_name = os.path.join(ep_path, '%s.ext' % ep_name)
+        if full_name not in log_lists[log_key].get('dedupe_list'):
+            log_lists[log_key]['dedupe_list'] += [full_name]
+
+            meta[urlkey(url)] = dict(show_name=show_name, season=season, episode=episode,
+                                     ep_name=ep_name, ep_base=ep_name, ep_ext=ep_ext, ep_path=ep_path,
+                                     ep_url=url, log_key=log_key, log_name=full_name)
+            return True
+    return False
+
+
+# add the episodes in the grid of a streamed season page to episodes, returns those not already listed
+def read_season(resp):
+    global num_member_access
+    found = []
+    if None is resp:
+        return found
+    try:
+        showname = showname_maps.get(urlkey(resp.request.url))
+        for ep, member_only in season_episodes(iter_response(resp)):
+            if member_only:
+                num_member_access += 1
+                if free_access_only:
+                    continue
+            if ep not in episodes:
+                episodes.append(ep)
+                found += [ep]
+
+            if None is not showname:
+                showname_maps[urlkey(ep)] = showname
+    except (StandardError, Exception):
+        pass
+    finally:
+        release(resp)
+    return found
+
+
+# site order, yield each new episode once its season page is read instead of after the whole crawl
+# season pages are swarmed ahead in site order while the episodes of earlier pages download (simple_requests runs
+# later calls first), on a session of their own that shares the login cookies and pools, as fetch_meta streams the
+# account session and a page left streamed while it waits its turn would hold its connection open
+def crawl_site(ep_urls, season_urls):
+    set_phase('planning')
+    for ep_url in ep_urls:
+        if plan_episode(ep_url):
+            yield ep_url
+
+    ahead = Requests(concurrent=concurrent_fetches, defaultTimeout=20, responsePreprocessor=SkipErrors())
+    ahead.session.cookies = session.cookies
+    ahead.session.headers.update(session.headers)
+    ahead.session.verify = session.verify
+    mount_pools(ahead.session)
+    try:
+        set_phase('crawl')
+        for resp in ahead.swarm(season_urls, maintainOrder=True):
+            if abort:
+                return
+            found = read_season(resp)
+            set_phase('planning')
+            for ep_url in found:
+                if plan_episode(ep_url):
+                    yield ep_url
+            set_phase('crawl')
+    finally:
+        ahead.stop()
+
+
+# yield episodes, then those deferred for lack of temp space once pending archive copies have freed what they can,
+# an episode is only retried when temp room has grown since it was deferred, else its meta would be fetched for nothing
+def with_deferred(ep_urls, deferred):
+    for ep_url in ep_urls:
+        yield ep_url
+    while deferred:
+        ep_url = deferred.pop(0)
+        wait_published()
+        if temp_room() <= meta[urlkey(ep_url)]['deferred_room']:
+            print('Not enough temp space for deferred episode, it is left for a later run: %s' % ep_url)
+            continue
+        yield ep_url
+
+
+# sort key for newest/oldest ep_priority, Specials sort as oldest
+def ep_order(ep_meta):
+    try:
+        return int(ep_meta['season']), int(ep_meta['episode'])
+    except (TypeError, ValueError):
+        return -1, -1
+
+
+# bytes of the process peak resident memory so far, used for phase peaks when tracemalloc is not available (Python 2)
+def peak_rss():
+    if 'win32' == sys.platform:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        try:
+            ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                     ctypes.byref(counters), counters.cb)
+        except (StandardError, Exception):
+            return 0
+        return counters.PeakWorkingSetSize
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * ('darwin' == sys.platform and 1 or 1024)
+
+
+# end the current phase and start the named phase, or stop with None, phases are timed for profile and plan modes
+def set_phase(name=None):
+    global phase_now, phase_start
+    if not (profile_mode or plan_mode):
+        return
+    mem_trace = 'full' == profile_mode and tracemalloc and tracemalloc.is_tracing()
+    if phase_now:
+        stats = phase_stats[phase_now]
+        if stats['profiler']:
+            stats['profiler'].disable()
+        stats['wall'] += time.time() - phase_start[0]
+        stats['cpu'] += sum(os.times()[:2]) - phase_start[1]
+        if mem_trace:
+            stats['peak'] = max(stats['peak'], tracemalloc.get_traced_memory()[1])
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            for diff in snapshot.compare_to(stats['snapshot'], 'lineno'):
+                alloc = stats['alloc'].setdefault(str(diff.traceback), [0, 0])
+                alloc[0] += diff.size_diff
+                alloc[1] += diff.count_diff
+        elif profile_mode:
+            # the process high water mark, so a phase shows the peak reached by the time it ended
+            stats['peak'] = max(stats['peak'], peak_rss())
+
+    if not name:
+        phase_now = None
+    else:
+        stats = phase_stats.setdefault(name, dict(entries=0, wall=0.0, cpu=0.0, peak=0, alloc={}, samples={},
+                                                  profiler=('full' == profile_mode and cProfile.Profile() or None)))
+        # only set once the stats exist, the sampler thread reads phase_now
+        phase_now = name
+        stats['entries'] += 1
+        if mem_trace:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            stats['snapshot'] = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+        phase_start = time.time(), sum(os.times()[:2])
+        if stats['profiler']:
+            stats['profiler'].enable()
+
+
+# low overhead alternative to cProfile, count the main thread call stack every interval for the current phase
+def profile_sampler(main_id, interval=0.01):
+    while not sampler_stop.wait(interval):
+        frame = sys._current_frames().get(main_id)
+        name = phase_now
+        if not name or not frame:
+            continue
+        stack = []
+        while frame:
+            stack += ['%s:%s(%s)' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)]
+            frame = frame.f_back
+        stats = phase_stats.get(name)
+        if not stats:
+            continue
+        samples = stats['samples']
+        folded = ';'.join(reversed(stack))
+        samples[folded] = samples.get(folded, 0) + 1
+
+
+def save_profile():
+    set_phase()
+    # stop the sampler before the summary, left running it can fail in interpreter shutdown
+    if sampler:
+        sampler_stop.set()
+        sampler.join()
+    if not phase_stats:
+        return
+    make_path(profile_dir)
+    rows = [('Phase', 'Entries', 'Wall secs', 'CPU secs', 'Peak MB', 'Samples')]
+    for name, stats in sorted(phase_stats.items(), key=lambda item: item[1]['wall'], reverse=True):
+        samples = dict(stats['samples'])
+        rows += [(name, str(stats['entries']), '%.2f' % stats['wall'], '%.2f' % stats['cpu'],
+                  stats['peak'] and '%.1f' % (stats['peak'] / 1048576.0) or '-', str(sum(samples.values())))]
+        if stats['profiler']:
+            stats['profiler'].dump_stats(os.path.join(profile_dir, '%s.pstats' % name))
+            with open(os.path.join(profile_dir, '%s.txt' % name), 'w') as fh:
+                pstats.Stats(stats['profiler'], stream=fh).sort_stats('cumulative').print_stats(40)
+        if stats['alloc']:
+            with open(os.path.join(profile_dir, '%s.alloc.txt' % name), 'w') as fh:
+                fh.write('Size diff KB, Count diff, Allocation site\n')
+                for site, (size, count) in sorted(stats['alloc'].items(), key=lambda item: item[1][0],
+                                                  reverse=True)[:25]:
+                    fh.write('%.1f, %s, %s\n' % (size / 1024.0, count, site))
+        if samples:
+            # folded stacks, can be fed to flamegraph.pl
+            with open(os.path.join(profile_dir, '%s.folded' % name), 'w') as fh:
+                for folded, count in sorted(samples.items(), key=lambda item: item[1], reverse=True):
+                    fh.write('%s %s\n' % (folded, count))
+
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(rows[0]))]
+    table = ['  '.join([col.ljust(widths[i]) for i, col in enumerate(row)]) for row in rows]
+    with open(os.path.join(profile_dir, 'summary.txt'), 'w') as fh:
+        fh.write('\n'.join(table) + '\n')
+    print('\n'.join(table))
+    print('Profile saved to: %s' % profile_dir)
+
+
 def sig_handler(signum=None, _=None):
     global abort
     is_ctrlbreak = 'win32' == sys.platform and signal.SIGBREAK == signum
@@ -166,18 +843,13 @@ def sig_handler(signum=None, _=None):
 
 class RespProcessor(ResponsePreprocessor):
 
+    def __init__(self, workspace):
+        self.workspace = workspace
+
     def success(self, bundle):
 
         if bundle.response.ok:
-            # ensure the data dir can be created
-            path = meta[urlkey(url)]['ep_path']
-            if not os.access(path, os.F_OK):
-                try:
-                    os.makedirs(path, 0o744)
-                except os.error:
-                    print(u'Unable to create dir: %s' % path)
-
-            save_name = os.path.join(temp_files, bundle.request.url.rsplit('/', 1)[-1])
+            save_name = os.path.join(self.workspace, bundle.request.url.rsplit('/', 1)[-1])
             try:
                 with open(save_name, 'wb') as fh:
                     fh.write(bundle.response.content)
@@ -187,9 +859,115 @@ class RespProcessor(ResponsePreprocessor):
         return super(RespProcessor, self).success(bundle)
 
 
+class PoolAdapter(requests.adapters.HTTPAdapter):
+    # keep-alive connection pools that are shared between the sessions of all accounts
+
+    def __init__(self, pool_size, timeout):
+        self.timeout = timeout
+        self.retired = {}
+        self.connects = {}
+        super(PoolAdapter, self).__init__(pool_connections=20, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self.retire
+        pool_classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = dict(
+            [(scheme, self.counting_pool(pool_cls)) for scheme, pool_cls in pool_classes.items()])
+
+    # a pool class whose connections count each connect per host, urllib3 reopens a dropped connection on the same
+    # object without counting it in num_connections
+    def counting_pool(self, pool_cls):
+        connects = self.connects
+
+        class CountingConnection(pool_cls.ConnectionCls):
+
+            def connect(self):
+                host = '%s://%s' % (pool_cls.scheme, self.host)
+                connects[host] = connects.get(host, 0) + 1
+                return super(CountingConnection, self).connect()
+
+        return type(pool_cls.__name__, (pool_cls,), dict(ConnectionCls=CountingConnection))
+
+    def get_connection(self, *args, **kwargs):
+        pool = super(PoolAdapter, self).get_connection(*args, **kwargs)
+        pool.last_used = time.time()
+        return pool
+
+    # requests 2.32+ uses this instead of get_connection
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        pool = super(PoolAdapter, self).get_connection_with_tls_context(*args, **kwargs)
+        pool.last_used = time.time()
+        return pool
+
+    def send(self, request, timeout=None, **kwargs):
+        return super(PoolAdapter, self).send(request, timeout=timeout or self.timeout, **kwargs)
+
+    # keep the request count of a pool that is closed
+    def retire(self, pool):
+        host = '%s://%s' % (pool.scheme, pool.host)
+        self.retired[host] = self.retired.get(host, 0) + pool.num_requests
+        pool.close()
+
+    def evict_idle(self, max_idle):
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool and max_idle < time.time() - getattr(pool, 'last_used', time.time()):
+                del pools[key]
+
+    # return {host: [requests, connects]}
+    def stats(self):
+        counts = dict([(host, [num_requests, 0]) for host, num_requests in self.retired.items()])
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                counts.setdefault('%s://%s' % (pool.scheme, pool.host), [0, 0])[0] += pool.num_requests
+        for host, num_connects in self.connects.items():
+            counts.setdefault(host, [0, 0])[1] += num_connects
+        return counts
+
+
+class SkipErrors(ResponsePreprocessor):
+    # a page that fails after retries is returned as None instead of raising out of the swarm
+
+    def error(self, bundle):
+        return None
+
+
+# mount the shared pools onto a session, the longest matching url prefix in pool_sizes sets a host pool size
+def mount_pools(session):
+    if not pool_adapters:
+        pool_adapters['http://'] = pool_adapters['https://'] = PoolAdapter(concurrent_fetches, 20)
+        for prefix, size in pool_sizes.items():
+            pool_adapters[prefix] = PoolAdapter(size, 20)
+    for prefix, adapter in pool_adapters.items():
+        session.mount(prefix, adapter)
+
+
+def evict_idle_pools():
+    for adapter in set(pool_adapters.values()):
+        adapter.evict_idle(pool_idle)
+
+
+def print_pool_stats():
+    counts = {}
+    for adapter in set(pool_adapters.values()):
+        for host, (num_requests, num_connections) in adapter.stats().items():
+            host_counts = counts.setdefault(host, [0, 0])
+            host_counts[0] += num_requests
+            host_counts[1] += num_connections
+    for host, (num_requests, num_connections) in sorted(counts.items()):
+        print('Connections to %s: %s request(s) over %s connection(s), %.0f%% reused' % (
+            host, num_requests, num_connections,
+            num_requests and 100.0 * (num_requests - num_connections) / num_requests or 0))
+
+
 # ####
 # Main
 # ####
+started = time.time()
 # If CTRL-C pressed, this will gracefully exit saving current downloading parts
 abort = False
 signal.signal(signal.SIGINT, sig_handler)
@@ -198,8 +976,40 @@ if 'win32' == sys.platform:
     signal.signal(signal.SIGBREAK, sig_handler)
 
 userdb = os.path.join(os.path.realpath(os.path.dirname(__file__)), 'rooster_user.db')
+ffmpegdb = os.path.join(os.path.realpath(os.path.dirname(__file__)), 'rooster_ffmpeg.db')
 now = datetime.datetime.now()
+
+profile_mode = None
+plan_mode = False
+for arg in sys.argv[1:]:
+    if arg in ('--profile', '--profile=sample'):
+        profile_mode = ('full', 'sample')['--profile=sample' == arg]
+    elif '--plan' == arg:
+        plan_mode = True
+plan = dict(created=now.isoformat(), accounts=[])
+plan_out = sys.stdout
+if plan_mode:
+    # keep stdout for the plan
+    sys.stdout = sys.stderr
+profile_dir = os.path.join(os.path.realpath(os.path.dirname(__file__)), '_rooster_profile',
+                           now.strftime('%Y%m%d-%H%M%S'))
+phase_stats = {}
+phase_now = None
+phase_start = None
+sampler = None
+sampler_stop = threading.Event()
+if 'full' == profile_mode and tracemalloc:
+    tracemalloc.start()
+elif 'sample' == profile_mode:
+    sampler = threading.Thread(target=profile_sampler, args=(threading.current_thread().ident,), name='sampler')
+    sampler.daemon = True
+    sampler.start()
+set_phase('startup')
 slept = 0
+num_saved = 0
+publisher = None
+publish_q = queue.Queue()
+publish_lock = threading.Lock()
 
 userlist = load_obj(userdb) or {}
 users = userlist.keys()
@@ -228,31 +1038,19 @@ if changed:
     save_userlist()
     changed = False
 
+if not plan_mode:
+    print('ffmpeg found: %s' % probe_ffmpeg())
 
-ffmpeg_buffer = None
-try:
-    ffmpeg_buffer = subprocess.Popen([ffmpeg_bin, '-version'],
-                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
-    ffmpeg_version = re.findall(r'(?sim)^(.*?version\s+[^\s]+)', ''.join([out for out in ffmpeg_buffer if out]))[0]
-    print('ffmpeg found: %s' % ffmpeg_version)
-except OSError:
-    print('Error: Ffmpeg not installed, check that its executable is installed at: %s' % ffmpeg_bin)
-    exit(1)
-except IndexError:
-    print('Error: Ffmpeg with version not found, check that its executable is installed at: %s' % ffmpeg_bin)
-    exit(1)
-
+# temp dirs are created once there is an episode to fetch
 if not re.search('(?i)^(?:[a-z]:[\\]|[/])', temp_files):
     temp_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), temp_files)
-if not os.access(temp_files, os.F_OK):
-    try:
-        os.makedirs(temp_files, 0o744)
-    except os.error:
-        print(u'Unable to create required temp dir: %s' % temp_files)
-        exit(1)
+if not re.search('(?i)^(?:[a-z]:[\\]|[/])', stage_files):
+    stage_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), stage_files)
 
 
 test_msg = ('', ' (Test mode, first 3 episode parts are fetched)')[bool(test_mode)]
+if plan_mode:
+    test_msg = ' (Plan mode, new episodes are listed but not fetched)'
 test_bars = '-' * len(test_msg)
 print('-------------------------' + test_bars)
 print('Rooster - Content fetcher' + test_msg)
@@ -260,16 +1058,19 @@ print('-------------------------' + test_bars)
 
 
 num_member_access = 0
-num_saved = 0
+pool_adapters = {}
 num_creds = len(userlist)
-concurrent_fetches = 5
 # noinspection PyCompatibility
 for username, userdata in userlist.iteritems():
 
     start = time.time()
+    set_phase('login')
 
+    # a new session per account keeps cookies apart, the shared pools keep connections alive between accounts
     req = Requests(concurrent=concurrent_fetches, defaultTimeout=20)
     session = req.session
+    mount_pools(session)
+    evict_idle_pools()
     session.verify = False
     session.headers.update({'User-Agent': 'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; Trident/6.0)',
                             'Accept-Encoding': 'gzip,deflate'})
@@ -333,9 +1134,12 @@ for username, userdata in userlist.iteritems():
         print('Login failed')
         continue
 
+    set_phase('crawl')
     episodes = []
     url_q = []
     showname_maps = {}
+    meta = {}
+    log_lists = {}
     for url in urls:
         showname = None
         if isinstance(url, dict):
@@ -353,184 +1157,88 @@ for username, userdata in userlist.iteritems():
         else:
             url_q += [url]
 
-    for resp in req.swarm(url_q, maintainOrder=False):
-        if abort:
-            req.stop()
-            break
-
-        season_block = ''
-        try:
-            season_block = re.findall('(?sim)grid-blocks.*begin\sfooter', resp.content)[0]
-        except (StandardError, Exception):
-            pass
-
-        showname = showname_maps.get(urlkey(resp.request.url))
-        for ep_block in re.findall('(?sim)<li>.*?post-stamp[^<]+</p>', season_block):
-            if re.findall('(?sim)ion-star', ep_block):
-                num_member_access += 1
-                if free_access_only:
-                    continue
-            for ep in re.findall('href="(https?://roosterteeth.com/episode/.*?)"', ep_block):
-                if ep not in episodes:
-                    episodes += [ep]
-
-                if None is not showname:
-                    showname_maps[urlkey(ep)] = showname
-
-    # parse url into usable fragments (where x=season num and y=episode num) from...
-    #  show_name-x-y
-    #  show_name-season-x-y
-    #  show_name-season-x-y
-    #  show_name-volume-x-y
-    #  show_name-volume-x-y
-    #  show_name-season-x-episode-y
-    #  show_name-season-x-chapter-y
-    #  show_name-volume-x-episode-y
-    #  show_name-volume-x-chapter-y
-    # Otherwise treat as Special
-    meta = {}
-    log_lists = {}
-    for url in episodes:
-        show_name, season, episode, ep_path, log_path = 5 * [None]
-        try:
-            show_name_parts = re.findall('episode/([^"]+?)[-](.*)', url)[0]
-            show_name, remaining1 = show_name_parts[0], show_name_parts[1]
-            show_name = showname_maps.get(urlkey(url), show_name)
-
-            if re.search('(?i)^(?:[a-z]:[\\]|[/])', show_parent):
-                ep_path = os.path.join(os.path.realpath(show_parent), show_name)
-            else:
-                ep_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), show_parent, show_name)
-            log_path = os.path.join(ep_path, '_log')
-
-            season_parts = re.findall('(?:season-|volume-)?(\d+|20\d\d)(.*)', remaining1)[0]
-            season, remaining2 = season_parts[0], season_parts[1]
-            try:
-                # remove erroneous duplication before further parsing
-                remaining2 = re.findall('.*(?:season-|volume-)(\d+|20\d\d)(.*)', remaining2)[0][1]
-            except IndexError:
-                pass
-
-            episode = re.findall('^-(?:episode-|chapter-)?(\d+)', remaining2)[0]
-
-            season = '%02d' % int(season)
-            episode = '%02d' % int(episode)
-            season_dir = season_template % (dict(season_number=season))
-            log_path = os.path.join(log_path, season_dir)
-            ep_path = os.path.join(ep_path, season_dir)
-            ep_name = ep_template % (dict(show_name=show_name, season=season, episode=episode))
+    if 'site' == ep_priority and not plan_mode:
+        # episodes are planned and fetched as each season page is read, so fetching starts before the crawl ends
+        num_snatch = (None, test_num_snatch)[bool(test_mode)]
+        planned = crawl_site(episodes[:], url_q)
+    else:
+        # season pages are streamed so that reading stops at the end of the episode grid
+        session.stream = True
+        for resp in req.swarm(url_q, maintainOrder=False):
+            if abort:
+                req.stop()
+                break
+            read_season(resp)
+        session.stream = False
+
+        set_phase('planning')
+        planned = filter(plan_episode, episodes)
+        num_snatch = (len(planned), test_num_snatch)[bool(test_mode)]
+    if ep_priority in ('newest', 'oldest'):
+        planned.sort(key=lambda ep_url: ep_order(meta[urlkey(ep_url)]), reverse='newest' == ep_priority)
+
+    if plan_mode:
+        plan_eps = []
+        for ep_url in planned:
+            ep_meta = meta[urlkey(ep_url)]
+            plan_eps += [dict([(k, ep_meta[k]) for k in
+                               ('ep_url', 'show_name', 'season', 'episode', 'ep_name', 'ep_path', 'log_name')])]
+        plan['accounts'] += [dict(username=username, episodes=plan_eps)]
+        # nothing is fetched, the account still ends as normal below
+        planned = []
+    elif None is num_snatch:
+        print('Attempting to fetch new episode(s) as each season page is read...')
+    else:
+        print('Attempting to fetch %s episode(s)...' % num_snatch)
+    if 'smallest' == ep_priority and planned:
+        # sizes are needed up front to order by, then meta is fetched again just before each download
+        set_phase('metadata')
+        for url in planned:
+            if abort:
+                break
+            if fetch_meta(url):
+                meta[urlkey(url)]['size_hint'] = meta[urlkey(url)]['est_bytes'][0]
+                del meta[urlkey(url)]['playlists']
+        planned.sort(key=lambda ep_url: meta[urlkey(ep_url)].get('size_hint') or sys.maxsize)
 
-        except IndexError:
-            if ep_path:
-                log_path = os.path.join(log_path, 'Specials')
-                ep_path = os.path.join(ep_path, 'Specials')
-                ep_name = url.rsplit('/', 1)[-1]
-
-        if show_name and ep_path:
-
-            # only add url to fetch meta where episode file does not already exist in _filelist.txt
-            log_file = os.path.join(log_path, '_filelist.txt')
-            log_key = urlkey(log_file)
-            if log_key not in log_lists:
-                file_list = []
-                if os.path.exists(log_file):
-                    with open(log_file, 'r') as rh:
-                        file_list = rh.readlines()
-                    file_list = [x.strip() for x in file_list]
-                log_lists[log_key] = dict(log_file=log_file, file_list=file_list[:], dedupe_list=file_list)
-
-            full_name = os.path.join(ep_path, '%s.ext' % ep_name)
-            if full_name not in log_lists[log_key].get('dedupe_list'):
-                log_lists[log_key]['dedupe_list'] += [full_name]
-
-                meta[urlkey(url)] = dict(show_name=show_name, season=season, episode=episode,
-                                         ep_name=ep_name, ep_ext=ep_ext, ep_path=ep_path, ep_url=url,
-                                         log_key=log_key, log_name=full_name)
-
-    num_snatch = (len(meta), test_num_snatch)[bool(test_mode)]
-    print('Attempting to fetch %s episode(s)...' % num_snatch)
-    for n, url in enumerate(filter(lambda ep_url: urlkey(ep_url) in meta, episodes)):
+    deferred = []
+    for n, url in enumerate(with_deferred(planned, deferred)):
         if abort or (test_mode and n == num_snatch):
             break
 
-        print('Episode page: %s' % url)
-        try:
-            sleep_random()
-            resp = req.one(url)
-        except (StandardError, Exception):
-            continue
-
-        if abort:
-            break
-
-        if resp:
-            if resp.ok:
-                try:
-                    meta_url_m3u8 = re.findall('file:.*?["\']([^"\']+)', resp.content)[0]
-                except IndexError:
-                    continue
-                if ep_append_title:
-                    try:
-                        meta_title = re.findall('videoTitle:.*?["\'](.*)\'', resp.content)[0]
-
-                        # strip out any bad chars
-                        for c in bad_chars:
-                            meta_title = meta_title.replace(c, '')
-
-                        title_parts = re.split('-', meta_title)
-                        if 1 < len(title_parts):
-                            meta[urlkey(url)]['ep_name'] += ep_append_title % dict(
-                                title=' - '.join([tp.strip() for tp in title_parts]),
-                                title_last_part=title_parts[-1].strip())
-                    except IndexError:
-                        pass
-            else:
-                print('Error response contains code:%s with short reason:%s' % (resp.status_code, resp.reason))
-                continue
-        else:
-            print('Error no data returned from server, check the site in a browser')
-            continue
-
-        print('Fetching episode meta...')
-        try:
-            sleep_random()
-            index_m3u8 = req.one(meta_url_m3u8)
-        except (StandardError, Exception):
-            continue
-        if abort:
-            break
-
-        try:
-            options = re.findall('(?im)^.*(?:resolution=(\d+)x(\d+)).*[\r\n]+(.*)$', index_m3u8.content)
-        except (StandardError, Exception):
-            options = []
-        if not options:
-            print('m3u8 response has no resolution to pick best from, skipping episode: %s' % url)
+        evict_idle_pools()
+        set_phase('metadata')
+        if not fetch_meta(url):
             continue
+        options = meta[urlkey(url)]['options']
+        base_url = meta[urlkey(url)]['base_url']
 
-        options = [(int(res_x), int(res_y), m3u8_url) for (res_x, res_y, m3u8_url) in options]
-        options.sort(key=lambda tu: tu[0], reverse=True)
-
-        base_url = meta_url_m3u8.rsplit('/', 1)[0]
+        # parts are kept in a workspace per episode so leftovers from an aborted run never collide across episodes
+        make_temp_dirs()
+        workspace = os.path.join(temp_files, urlkey(url))
+        make_path(workspace)
 
         pick = 0
         video_urls = []
         # if iteration fails clear video_urls to fallback to next res
         while pick != len(options) and not video_urls:
+            set_phase('parts')
             res = '%s x %s' % (options[pick][0], options[pick][1])
             res_file_name = re.search('(72|108|216)0', str(options[pick][1])) and '.%sp' % options[pick][1] or ''
 
-            sleep_random()
-            try:
-                pick_url = options[pick][2]
-                data_m3u8 = req.one(('%s/%s' % (base_url, pick_url), pick_url)[pick_url.startswith('http')])
-            except (StandardError, Exception):
-                pick += 1
-                continue
-            if abort:
-                break
+            pick_url = options[pick][2]
+            data_m3u8 = meta[urlkey(url)]['playlists'].get(pick_url)
+            if not data_m3u8:
+                sleep_random()
+                try:
+                    data_m3u8 = req.one(('%s/%s' % (base_url, pick_url), pick_url)[pick_url.startswith('http')]).content
+                except (StandardError, Exception):
+                    pick += 1
+                    continue
+                if abort:
+                    break
 
-            for v in re.findall('(?im)#EXTINF:.*?[\r\n]+(.*?)$', data_m3u8.content):
+            for v in re.findall('(?im)#EXTINF:.*?[\r\n]+(.*?)$', data_m3u8):
                 if v.startswith('http'):
                     video_urls += [v]
                 else:
@@ -543,11 +1251,32 @@ for username, userdata in userlist.iteritems():
                     else:
                         video_urls += ['%s/%s' % (base_url, v)]
 
+            est_bytes = meta[urlkey(url)]['est_bytes'][pick]
             pick += 1
 
             if not video_urls:
                 continue
 
+            if test_mode:
+                est_bytes = int(est_bytes * min(1.0, float(num_snatch) / len(video_urls)))
+            fetches = admit(est_bytes, len(video_urls), workspace)
+            if not fetches:
+                video_urls = []
+                if ep_fallback and pick != len(options):
+                    print('Skipping resolution %s, estimated %.1f MB does not fit in temp space' % (
+                        res, est_bytes / 1048576.0))
+                    continue  # attempt next best resolution
+                if not meta[urlkey(url)].get('deferred'):
+                    meta[urlkey(url)]['deferred'] = True
+                    meta[urlkey(url)]['deferred_room'] = temp_room()
+                    deferred += [url]
+                    print('Deferring episode, estimated %.1f MB does not fit in temp space, retry after others' % (
+                        est_bytes / 1048576.0))
+                else:
+                    print('Not enough temp space for episode, estimated %.1f MB, it is left for a later run' % (
+                        est_bytes / 1048576.0))
+                break
+
             if re.search('(?i)\.mp4.*?\.ts$', video_urls[-1]):
                 meta[urlkey(url)]['ep_ext'] = '.mp4'
 
@@ -556,18 +1285,23 @@ for username, userdata in userlist.iteritems():
             print('Fetching %s parts(s) for %s resolution %s' % (
                 (len(video_urls), '%s/%s (test mode)' % (num_snatch, len(video_urls)))[bool(test_mode)],
                 meta[urlkey(url)]['ep_ext'], res))
+            if fetches < concurrent_fetches:
+                print('Fetching %s part(s) at a time to stay within memory_budget' % fetches)
             saved = []
             _print('Parts: ')
             url_q = []
+            save_order = []
             for video_url in video_urls:
-                if test_mode and num_snatch == len(saved):
+                if test_mode and num_snatch == len(save_order):
                     break
 
                 if abort:
                     break
 
+                path_name = os.path.join(workspace, video_url.rsplit('/', 1)[-1])
+                save_order += [path_name]
+
                 # skip over already saved intermediate files
-                path_name = os.path.join(temp_files, video_url.rsplit('/', 1)[-1])
                 if os.path.exists(path_name):
                     saved += [path_name]
                     _print('# ')
@@ -575,17 +1309,17 @@ for username, userdata in userlist.iteritems():
 
                 url_q += [video_url]
 
-            save_order = [os.path.join(temp_files, uq.rsplit('/', 1)[-1]) for uq in url_q]
             progress = 0
             printed_done = []
             url_cnt = len(url_q)
             while not abort:
-                working_q = [url_q.pop(0) for x in range(0, concurrent_fetches) if x < len(url_q)]
+                working_q = [url_q.pop(0) for x in range(0, fetches) if x < len(url_q)]
                 if not working_q:
                     break
 
                 try:
-                    for data in req.swarm(working_q, maintainOrder=False, responsePreprocessor=RespProcessor()):
+                    for data in req.swarm(working_q, maintainOrder=False,
+                                          responsePreprocessor=RespProcessor(workspace)):
                         progress += 1
                         done = int(float(progress)/url_cnt * 100)
                         if done in (5, 20, 40, 60, 80, 95) and done not in printed_done:
@@ -599,7 +1333,7 @@ for username, userdata in userlist.iteritems():
 
                         if data:
                             if data.ok:
-                                saved += [os.path.join(temp_files, data.request.url.rsplit('/', 1)[-1])]
+                                saved += [os.path.join(workspace, data.request.url.rsplit('/', 1)[-1])]
                                 if test_mode and len(saved) >= num_snatch:
                                     req.stop()
                                     abort = True
@@ -631,8 +1365,9 @@ for username, userdata in userlist.iteritems():
                 video_urls = []  # attempt next best resolution
                 continue
 
+            set_phase('mux')
             file_name = '%s%s' % (meta[urlkey(url)]['ep_name'], '.txt')
-            ffmpeg_list = os.path.join(temp_files, file_name)
+            ffmpeg_list = os.path.join(workspace, file_name)
             try:
                 with open(ffmpeg_list, 'wb') as f:
                     f.write('file \'%s\'' % '\'\r\nfile \''.join([os.path.basename(s)
@@ -646,40 +1381,44 @@ for username, userdata in userlist.iteritems():
 
             final_name = '%s%s.WEBRip%s' % (
                 (meta[urlkey(url)]['ep_name']), res_file_name, meta[urlkey(url)]['ep_ext'])
+            stage_name = os.path.join(stage_files, final_name)
             cmd = [ffmpeg_bin, '-f', 'concat', '-safe', '0', '-i', ffmpeg_list, '-c', 'copy',
-                   '-bsf:a', 'aac_adtstoasc', '-y', os.path.join(meta[urlkey(url)]['ep_path'], final_name)]
-            ffmpeg_buffer = subprocess.Popen(cmd, cwd=temp_files,
+                   '-bsf:a', 'aac_adtstoasc', '-y', stage_name]
+            ffmpeg_buffer = subprocess.Popen(cmd, cwd=workspace,
                                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
             try:
                 result = re.findall('(video:\s*[^\s]+\saudio:\s*[^\s]+).*?muxing overhead', ffmpeg_buffer[0])[0]
-                print('Saved: %s %s' % (final_name, result))
-                remove(saved + [ffmpeg_list])
-
-                # ensure the log dir can be created
-                log_meta = log_lists[meta[urlkey(url)]['log_key']]
-                log_path = os.path.split(log_meta['log_file'])[0]
-                if not os.access(log_path, os.F_OK):
-                    try:
-                        os.makedirs(log_path, 0o744)
-                    except os.error:
-                        print(u'Unable to create dir: %s' % log_path)
-
-                log_meta['file_list'] += [meta[urlkey(url)]['log_name']]
-                with open(log_meta['log_file'], 'wb') as wh:
-                    wh.write('\r\n'.join(log_meta['file_list']))
-
-                num_saved += 1
             except (StandardError, Exception):
-                remove(saved + [ffmpeg_list, os.path.join(meta[urlkey(url)]['ep_path'], final_name)])
+                remove(saved + [ffmpeg_list, stage_name])
                 video_urls = []  # attempt next best resolution
                 print('Error: %s\r\n' % '\r\n'.join([line for line in ffmpeg_buffer[0].strip().split('\r\n')
                                                      if not re.search('^\s*(built|config|lib)', line)]))
                 continue
 
+            print('Saved: %s %s' % (final_name, result))
+            remove(saved + [ffmpeg_list])
+            publish(stage_name, os.path.join(meta[urlkey(url)]['ep_path'], final_name),
+                    log_lists[meta[urlkey(url)]['log_key']], meta[urlkey(url)]['log_name'])
+
+        # only an empty workspace is removed, parts of an aborted episode are kept to resume from
+        try:
+            os.rmdir(workspace)
+        except OSError:
+            pass
+
+    set_phase('publish')
+    wait_published()
+    set_phase()
+
     print('---')
-    print('Success. Saved %s/%s episodes %s %s member only access. (%.2f secs).' % (
-        num_saved, len(episodes), ('with', 'skipping')[free_access_only], num_member_access,
-        (time.time() - start) - slept))
+    if plan_mode:
+        print('Planned %s/%s new episodes %s %s member only access. (%.2f secs).' % (
+            len(plan['accounts'][-1]['episodes']), len(episodes), ('with', 'skipping')[free_access_only],
+            num_member_access, (time.time() - start) - slept))
+    else:
+        print('Success. Saved %s/%s episodes %s %s member only access. (%.2f secs).' % (
+            num_saved, len(episodes), ('with', 'skipping')[free_access_only], num_member_access,
+            (time.time() - start) - slept))
 
     num_creds -= 1
     if num_creds:
@@ -693,5 +1432,20 @@ if not client_creds:
 if changed:
     save_userlist()
 
+if pool_adapters:
+    print('----------------------------')
+    print_pool_stats()
+
+if profile_mode:
+    print('----------------------------')
+    save_profile()
+
+if plan_mode:
+    set_phase()
+    plan.update(dict(new_episodes=sum([len(account['episodes']) for account in plan['accounts']]),
+                     member_only=num_member_access, total_secs=round(time.time() - started, 3),
+                     timings=dict([(name, round(stats['wall'], 3)) for name, stats in phase_stats.items()])))
+    plan_out.write(json.dumps(plan, indent=2, sort_keys=True) + '\n')
+
 print('----------------------------')
 print('Done.')
@@ -0,0 +1,226 @@
+from __future__ import print_function
+
+# ==============================================================================================
+# Rooster page extractors.
+#
+# Description:
+#
+#  Incremental parsers for season and episode pages that work on a response as it streams,
+#  and stop reading once the episode grid or the player config is found.
+#
+# Micro-benchmark against the full page regex scan, with one or more saved pages, run...
+#  python rooster_extract.py path/to/season.html path/to/episode.html
+#
+# ==============================================================================================
+
+import codecs
+import os
+import re
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+chunk_size = 16384
+# most of a page left unread after a match is read through so its keep-alive connection can be reused
+drain_limit = 131072
+
+grid_start = re.compile(r'(?i)grid-blocks')
+grid_end = re.compile(r'(?i)begin\sfooter')
+ep_block = re.compile(r'(?sim)<li>.*?post-stamp[^<]+</p>')
+ep_member = re.compile(r'(?sim)ion-star')
+ep_href = re.compile(r'href="(https?://roosterteeth.com/episode/.*?)"')
+player_file = re.compile(r'file:.*?["\']([^"\']+)')
+player_title = re.compile(r'videoTitle:.*?["\'](.*)\'')
+
+
+def iter_response(resp):
+    return resp.iter_content(chunk_size)
+
+
+def iter_file(filename):
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            yield chunk
+
+
+# decode bytes on Python 3, on Python 2 str chunks pass through as is
+def _text(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for chunk in chunks:
+        yield chunk if isinstance(chunk, str) else decoder.decode(chunk)
+
+
+def season_episodes(chunks):
+    """Yield (episode url, member only) for each episode in the grid of a season page.
+
+    Reading ends at the footer that follows the grid, the caller should then close the response.
+    """
+    buf = ''
+    found = False
+    for chunk in _text(chunks):
+        buf += chunk
+        if not found:
+            match = grid_start.search(buf)
+            if not match:
+                buf = buf[-len('grid-blocks'):]
+                continue
+            found = True
+            buf = buf[match.end():]
+
+        end = grid_end.search(buf)
+        scan = buf
+        if end:
+            scan = buf[:end.start()]
+        pos = 0
+        for match in ep_block.finditer(scan):
+            pos = match.end()
+            member = bool(ep_member.search(match.group(0)))
+            urls = []
+            for url in ep_href.findall(match.group(0)):
+                if url not in urls:
+                    urls += [url]
+                    yield url, member
+        if end:
+            return
+
+        # keep only from the first unfinished episode block, or enough to match a block or footer that is split
+        buf = buf[pos:]
+        start = buf.find('<li>')
+        buf = (-1 != start and buf[start:]) or buf[-len('begin footer'):]
+
+
+def player_config(chunks, want_title=True):
+    """Return (m3u8 url, video title) from an episode page, either may be None if not found.
+
+    Reading ends once the values are found, the caller should then close the response.
+    """
+    buf = ''
+    meta_url, title = None, None
+    for chunk in _text(chunks):
+        buf += chunk
+        if None is meta_url:
+            match = player_file.search(buf)
+            # a url that runs to the end of what is read so far can continue in the next chunk
+            if match and match.end() < len(buf):
+                meta_url = match.group(1)
+        if want_title and None is title:
+            match = player_title.search(buf)
+            # the title runs to the last quote of its line, so the line must be complete
+            if match and -1 != buf.find('\n', match.end()):
+                title = match.group(1)
+        if None is not meta_url and (title or not want_title):
+            break
+
+        # a match can only start at its token, so text before the first unfinished token is dropped
+        cut = len(buf)
+        for done, token in ((meta_url, 'file:'), (title or not want_title, 'videoTitle:')):
+            if not done:
+                pos = buf.find(token)
+                cut = min(cut, (pos, len(buf) - len(token))[-1 == pos])
+        buf = buf[max(cut, 0):]
+    else:
+        if None is meta_url:
+            meta_url = (player_file.findall(buf) or [None])[0]
+        if want_title and None is title:
+            title = (player_title.findall(buf) or [None])[0]
+    return meta_url, title
+
+
+def release(resp):
+    """Close a streamed response that may be partly read.
+
+    Up to drain_limit bytes left of the body are read to the end first, which returns its connection to the pool,
+    a body with more left, by Content-Length or once the limit is read, is closed along with its connection.
+    """
+    try:
+        length = resp.headers.get('content-length')
+        if not length or int(length) - resp.raw.tell() <= drain_limit:
+            left = drain_limit
+            while 0 < left:
+                data = resp.raw.read(chunk_size, decode_content=False)
+                if not data:
+                    break
+                left -= len(data)
+    except Exception:
+        pass
+    resp.close()
+
+
+# the full page scans done before the extractors, for comparison
+def _full_season(filename):
+    with open(filename, 'rb') as fh:
+        data = ''.join(_text([fh.read()]))
+    episodes = []
+    season_block = ''
+    try:
+        season_block = re.findall(r'(?sim)grid-blocks.*begin\sfooter', data)[0]
+    except IndexError:
+        pass
+    for block in re.findall(r'(?sim)<li>.*?post-stamp[^<]+</p>', season_block):
+        member = bool(re.findall(r'(?sim)ion-star', block))
+        for url in re.findall(r'href="(https?://roosterteeth.com/episode/.*?)"', block):
+            if (url, member) not in episodes:
+                episodes += [(url, member)]
+    return episodes
+
+
+def _full_player(filename):
+    with open(filename, 'rb') as fh:
+        data = ''.join(_text([fh.read()]))
+    return ((re.findall(r'file:.*?["\']([^"\']+)', data) or [None])[0],
+            (re.findall(r'videoTitle:.*?["\'](.*)\'', data) or [None])[0])
+
+
+def _stream_season(filename):
+    episodes = []
+    for entry in season_episodes(iter_file(filename)):
+        if entry not in episodes:
+            episodes += [entry]
+    return episodes
+
+
+def _stream_player(filename):
+    return player_config(iter_file(filename))
+
+
+def _measure(func, arg, runs):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    for _ in range(runs):
+        result = func(arg)
+    secs = (time.time() - start) / runs
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, secs, peak
+
+
+def _kb(num_bytes):
+    return None is num_bytes and '-' or '%.1f KB' % (num_bytes / 1024.0)
+
+
+def bench(filenames, runs=20):
+    for filename in filenames:
+        print('%s (%.1f KB)' % (os.path.basename(filename), os.path.getsize(filename) / 1024.0))
+        for name, full, stream in (('season grid', _full_season, _stream_season),
+                                   ('player config', _full_player, _stream_player)):
+            full_result, full_secs, full_peak = _measure(full, filename, runs)
+            stream_result, stream_secs, stream_peak = _measure(stream, filename, runs)
+            # without tracemalloc (Python 2) there is no peak to show
+            print('  %s, full scan: %.2f ms, peak %s .. streaming: %.2f ms, peak %s' % (
+                name, full_secs * 1000, _kb(full_peak), stream_secs * 1000, _kb(stream_peak)))
+            if full_result != stream_result:
+                print('  %s results differ, full scan: %s streaming: %s' % (name, full_result, stream_result))
+
+
+if '__main__' == __name__:
+    if 1 == len(sys.argv):
+        print('Usage: python rooster_extract.py saved_page.html [saved_page.html ...]')
+        sys.exit(1)
+    bench(sys.argv[1:])
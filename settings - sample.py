@@ -59,6 +59,41 @@ show_parent = '_rooster_shows'
 # Path where to build downloaded episode parts (absolute full path, or relative to <path/to/rooster>)
 temp_files = '_rooster_tmp'
 
+# Path where ffmpeg writes finished episodes before they are moved to show_parent (absolute full path, or relative to
+# <path/to/rooster>). Use fast local disk, when this is not on the same filesystem as show_parent, files are copied
+# and checked in the background, then renamed into place
+stage_files = '_rooster_stage'
+
+# Maximum MB of temp_files (and stage_files when on the same disk) to use, 0 to only limit to free disk space
+# An episode is only fetched when its estimated size fits, otherwise it is retried after the other episodes, then
+# left for a later run
+temp_budget = 0
+
+# Normally False, set ep_fallback True to fetch the next best resolution that fits when an episode does not fit in
+# temp space, instead of waiting to fetch it at the best resolution
+ep_fallback = False
+
+# Maximum number of episode parts fetched at once
+concurrent_fetches = 5
+
+# Maximum MB of episode parts held in memory at once while fetching, lowers the number of parts fetched together
+memory_budget = 256
+
+# Order to fetch episodes in
+#  ep_priority = 'site'  # Default, the order found on the site, fetching starts as soon as a season page is read
+#  ep_priority = 'newest'  # Highest season and episode first
+#  ep_priority = 'oldest'  # Lowest season and episode first
+#  ep_priority = 'smallest'  # Smallest estimated size first
+ep_priority = 'site'
+
+# Keep-alive connections are pooled per host and reused across episodes and accounts
+# Number of connections kept per host, by url prefix, hosts not matched here keep concurrent_fetches
+#  pool_sizes = {'https://roosterteeth.com': 2}
+pool_sizes = {}
+
+# Seconds a host pool can be unused before its connections are closed
+pool_idle = 60
+
 # Episode file naming template
 #
 #  Examples of baseline file naming pattern